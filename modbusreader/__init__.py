@@ -2,10 +2,14 @@ import os
 import modbusreader.structutils
 import logging
 import json
-from jsonschema import validate
+import functools
+import decimal
+import math
+import struct
+import fastjsonschema
+from jsonschema.exceptions import ValidationError
 from pymodbus3.client.sync import ModbusTcpClient
-from math import acos, asin, atan, atan2, ceil, cos, cosh, degrees, e, exp, fabs, floor, fmod, frexp, hypot, ldexp, \
-    log, log10, modf, pi, pow, radians, sin, sinh, sqrt, tan, tanh
+from pymodbus3.exceptions import ConnectionException
 
 
 __version__ = '1.0.5'
@@ -18,19 +22,103 @@ __dirname__ = os.path.dirname(os.path.abspath(__file__))
 
 logger = logging.getLogger(__name__)
 
-_safe_math_functions = dict([(k, locals().get(k, None)) for k in
-                             ['math', 'acos', 'asin', 'atan', 'atan2', 'ceil', 'cos', 'cosh', 'degrees', 'e', 'exp',
+_safe_math_functions = dict([(k, getattr(math, k)) for k in
+                             ['acos', 'asin', 'atan', 'atan2', 'ceil', 'cos', 'cosh', 'degrees', 'e', 'exp',
                               'fabs', 'floor', 'fmod', 'frexp', 'hypot', 'ldexp', 'log', 'log10', 'modf', 'pi', 'pow',
                               'radians', 'sin', 'sinh', 'sqrt', 'tan', 'tanh']
                              ])
 _safe_math_functions['abs'] = abs
 
+# template of the globals of error correction equations, every evaluation gets its own copy because an equation can
+# assign names in its globals
+_error_correction_globals = dict(_safe_math_functions)
+_error_correction_globals["__builtins__"] = None
+
+# maximum number of discretes or registers which can be read with a single modbus request
+_max_request_counts = {
+    "discrete_inputs": 2000,
+    "discrete_outputs": 2000,
+    "input_registers": 125,
+    "output_registers": 125
+}
+
+_modbus_device_definition_schema_file = __dirname__ + "/modbus_definition.schema.json"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_modbus_device_definition_validator():
+    with open(_modbus_device_definition_schema_file, 'r', encoding='utf-8') as schema_file:
+        return fastjsonschema.compile(json.load(schema_file))
+
+
+@functools.lru_cache(maxsize=16)
+def _load_modbus_device_definition_file(file_name, modification_time):
+    with open(file_name, 'r', encoding='utf-8') as modbus_device_definition_file:
+        return json.load(modbus_device_definition_file)
+
+
+def _get_register_runs(sensors, start_address, float_low_byte_first):
+    """
+    Splits the registers of a group into runs of consecutive registers of the same data type, so that every run can be
+    decoded with a single struct object.
+
+    :param sensors: registers of a group: { sensor_id: sensor_config, ... }
+    :type sensors: dict
+    :param start_address: start address of the group
+    :type start_address: int
+    :param float_low_byte_first: see :meth:`ModbusReader.__init__`
+    :type float_low_byte_first: bool
+
+    :return: runs as follows: [ { "slice": ..., "int16list_struct": ..., "struct": ..., "sensors": [ (sensor_id,
+            sensor_config), ... ] }, ... ]
+    :type: list
+
+    :raise ValueError: if the size of the data types of a run differs from the size of its registers
+    """
+    runs = list()
+    for sensor_id, sensor_config in sorted(sensors.items(), key=lambda sensor: sensor[1]["address"]):
+        if len(runs) > 0 and runs[-1]["type"] == sensor_config["type"] and \
+                runs[-1]["end_address"] == sensor_config["address"]:
+            run = runs[-1]
+        else:
+            run = {
+                "type": sensor_config["type"],
+                "start_address": sensor_config["address"],
+                "end_address": sensor_config["address"],
+                "sensors": list()
+            }
+            runs.append(run)
+        run["sensors"].append((sensor_id, sensor_config))
+        run["end_address"] += sensor_config["count"]
+
+    for run in runs:
+        position_start = run.pop("start_address") - start_address
+        position_end = run.pop("end_address") - start_address
+        data_type = run.pop("type")
+
+        # reversing all registers of a run swaps the registers of every float but also reverses the order of the floats
+        if data_type == "float" and float_low_byte_first:
+            run["slice"] = slice(position_end - 1, position_start - 1 if position_start > 0 else None, -1)
+            run["sensors"].reverse()
+        else:
+            run["slice"] = slice(position_start, position_end)
+
+        run["int16list_struct"] = struct.Struct(">" + str(position_end - position_start) + "H")
+        run["struct"] = struct.Struct(">" + str(len(run["sensors"])) + structutils.get_format(data_type))
+
+        # never unpack bytes which were not packed for this run
+        if run["struct"].size != run["int16list_struct"].size:
+            raise ValueError("Registers of data type " + data_type + " cannot be decoded at once: " +
+                             ", ".join(sensor_id for sensor_id, _ in run["sensors"]))
+
+    return runs
+
 
 class ModbusReader:
     """ModbusReader is an automated modbus client which reads all discretes and registers of a modbus server over TCP
     """
 
-    def __init__(self, host, port, unit, modbus_device_definition, float_low_byte_first=False):
+    def __init__(self, host, port, unit, modbus_device_definition, float_low_byte_first=False, max_gap=0):
         """
         Initializes a new instance
 
@@ -47,69 +135,109 @@ class ModbusReader:
                 possibilities for the determination of the float value. Set to True if float interpretation order is
                 Low Byte and then High Byte. Otherwise interpretation order is High Byte and then Low Byte.
         :type float_low_byte_first: bool
+        :param max_gap: maximum number of unused addresses between two sensors which are still read with a single
+                request. Only increase this value if the modbus server allows reading the unused addresses. A request
+                never exceeds 125 registers or 2000 discretes.
+        :type max_gap: int
 
         :raise ~jsonschema.exceptions.ValidationError: if the modbus device definition dictionary or file is invalid
-        :raise ~jsonschema.exceptions.SchemaError: if the modbus device definition config itself is invalid
+        :raise ValueError: if a register has a data type smaller than one register (byte, boolean) or if max_gap is
+                not a non-negative integer
+        :raise IOError: if connecting to the modbus server fails
         """
-        self._modbus_device_definition_schema_file = __dirname__ + "/modbus_definition.schema.json"
+        self._modbus_device_definition_schema_file = _modbus_device_definition_schema_file
         self.host = host
         self.port = port
         self.unit = unit
         self.float_low_byte_first = float_low_byte_first
+        self.max_gap = max_gap
 
-        if type(modbus_device_definition) is not dict:
-            modbus_device_definition = json.loads(open(modbus_device_definition, 'rb').read().decode("UTF-8"))
+        if not isinstance(modbus_device_definition, dict):
+            file_name = os.path.abspath(modbus_device_definition)
+            modbus_device_definition = _load_modbus_device_definition_file(file_name, os.path.getmtime(file_name))
 
-        validate(modbus_device_definition,
-                 json.loads(open(self._modbus_device_definition_schema_file, 'rb').read().decode("UTF-8")))
+        try:
+            _get_modbus_device_definition_validator()(modbus_device_definition)
+        except fastjsonschema.JsonSchemaException as ex:
+            raise ValidationError(ex.message) from ex
 
-        self.grouped_modbus_device_definition = self.group_modbus_device_definition(modbus_device_definition)
+        self.grouped_modbus_device_definition = self.group_modbus_device_definition(modbus_device_definition,
+                                                                                    self.float_low_byte_first,
+                                                                                    self.max_gap)
         self.client = ModbusTcpClient(host=self.host, port=self.port)
+        if not self.client.connect():
+            raise IOError("connecting to modbus server " + str(self.host) + ":" + str(self.port) + " failed")
+
+        # reused for decoding every run of registers, large enough for the longest one
+        self._register_buffer = bytearray(max(
+            [max(run["int16list_struct"].size, run["struct"].size)
+             for function_type in ["input_registers", "output_registers"]
+             for group in self.grouped_modbus_device_definition[function_type]
+             for run in group["_runs"]] + [0]))
+
+        self._discretes = {
+            "input": (self.grouped_modbus_device_definition["discrete_inputs"], self.client.read_discrete_inputs),
+            "output": (self.grouped_modbus_device_definition["discrete_outputs"], self.client.read_coils)
+        }
+        self._registers = {
+            "input": (self.grouped_modbus_device_definition["input_registers"], self.client.read_input_registers),
+            "output": (self.grouped_modbus_device_definition["output_registers"], self.client.read_holding_registers)
+        }
 
     @staticmethod
-    def group_modbus_device_definition(modbus_device_definition):
+    def group_modbus_device_definition(modbus_device_definition, float_low_byte_first=False, max_gap=0):
         """
         Groups modbus addresses. This method is needed, if there are gaps of non existent modbus addresses.
+        Additionally, the registers of every group are split into runs of the same data type which are decoded at
+        once, and the compiled error correction equation and the rounding precision of every register are
+        precomputed.
 
         :param modbus_device_definition: modbus device definition dictionary
         :type modbus_device_definition: dict
+        :param float_low_byte_first: see :meth:`__init__`
+        :type float_low_byte_first: bool
+        :param max_gap: see :meth:`__init__`
+        :type max_gap: int
 
         :return: grouped modbus device definition dictionary
         :type: dict
+
+        :raise ValueError: if a register has a data type smaller than one register (byte, boolean) or if max_gap is
+                not a non-negative integer
         """
 
+        if not isinstance(max_gap, int) or isinstance(max_gap, bool) or max_gap < 0:
+            raise ValueError("max_gap has to be a non-negative integer")
+
         grouped_sensors = dict()
 
         for function_type in ["discrete_inputs", "discrete_outputs", "input_registers", "output_registers"]:
+            max_request_count = _max_request_counts[function_type]
 
-            grouped_sensors.update({function_type: list()})
+            grouped_sensors[function_type] = list()
 
-            config_sensors = modbus_device_definition[function_type]
-            sorted_sensors = sorted(config_sensors.items(), key=lambda k: config_sensors[k[0]]['address'])
+            sorted_sensors = sorted(modbus_device_definition[function_type].items(),
+                                    key=lambda sensor: sensor[1]["address"])
+            next_sensors = sorted_sensors[1:] + [None]
 
             if function_type.startswith("discrete"):
                 start_address = None
                 last_address = None
                 sensors = dict()
 
-                for i in range(0, len(sorted_sensors)):
-                    sensor_id = sorted_sensors[i][0]
-                    sensor_config = sorted_sensors[i][1]
-
-                    current_address = sorted_sensors[i][1]["address"]
-                    if i < len(sorted_sensors) - 1:
-                        next_address = sorted_sensors[i + 1][1]["address"]
-                    else:
-                        next_address = None
+                for (sensor_id, sensor_config), next_sensor in zip(sorted_sensors, next_sensors):
+                    current_address = sensor_config["address"]
+                    next_address = next_sensor[1]["address"] if next_sensor is not None else None
 
                     if start_address is None:
                         start_address = current_address
 
-                    if last_address is None or last_address + 1 == current_address:
-                        sensors.update({sensor_id: sensor_config})
+                    if last_address is None or 0 <= current_address - (last_address + 1) <= max_gap:
+                        sensors[sensor_id] = dict(sensor_config)
                         last_address = current_address
 
-                    if next_address is None or current_address + 1 != next_address:
+                    if next_address is None or not 0 <= next_address - (current_address + 1) <= max_gap or \
+                            next_address + 1 - start_address > max_request_count:
                         grouped_sensors[function_type].append(
                             {
                                 "start_address": start_address,
@@ -126,32 +254,51 @@ class ModbusReader:
                 last_count = None
                 sensors = dict()
 
-                for i in range(0, len(sorted_sensors)):
-                    sensor_id = sorted_sensors[i][0]
-                    sensor_config = sorted_sensors[i][1]
-                    sensor_config.update({"count": int(structutils.calcsize(sorted_sensors[i][1]["type"]) / 2)})
+                for (sensor_id, sensor_config), next_sensor in zip(sorted_sensors, next_sensors):
+                    sensor_config = dict(sensor_config)
+                    sensor_config["count"] = int(structutils.calcsize(sensor_config["type"]) / 2)
+                    if sensor_config["count"] == 0:
+                        raise ValueError("Data type " + sensor_config["type"] + " of sensor id " + sensor_id +
+                                         " does not fill a whole register and cannot be read from " + function_type)
+
+                    if sensor_config["type"] in ["int16", "int32", "uint32"]:
+                        # number of decimal places of the factor, e.g. 2 for 0.25
+                        sensor_config["_round_digits"] = max(
+                            0, -decimal.Decimal(repr(sensor_config["factor"])).as_tuple().exponent)
 
-                    current_address = sorted_sensors[i][1]["address"]
-                    if i < len(sorted_sensors) - 1:
-                        next_address = sorted_sensors[i + 1][1]["address"]
+                    if "error_correction" in sensor_config:
+                        try:
+                            sensor_config["_equation"] = compile(sensor_config["error_correction"]["equation"],
+                                                                 "<error_correction>", "eval")
+                        except (SyntaxError, ValueError) as ex:
+                            logger.warning("Error correction equation of sensor id " + sensor_id +
+                                           " is invalid and will be ignored. Error details: " + str(ex))
+
+                    current_address = sensor_config["address"]
+                    if next_sensor is not None:
+                        next_address = next_sensor[1]["address"]
+                        next_count = structutils.calcsize(next_sensor[1]["type"]) // 2
                     else:
                         next_address = None
+                        next_count = None
 
                     if start_address is None:
                         start_address = current_address
 
-                    if last_address is None or last_address + last_count == current_address:
-                        sensor_config.update({"count": sensor_config["count"]})
-                        sensors.update({sensor_id: sensor_config})
+                    if last_address is None or 0 <= current_address - (last_address + last_count) <= max_gap:
+                        sensors[sensor_id] = sensor_config
                         last_address = current_address
                         last_count = sensor_config["count"]
 
-                    if next_address is None or current_address + sensor_config["count"] != next_address:
+                    if next_address is None or \
+                            not 0 <= next_address - (current_address + sensor_config["count"]) <= max_gap or \
+                            next_address + next_count - start_address > max_request_count:
                         grouped_sensors[function_type].append(
                             {
                                 "start_address": start_address,
                                 "count": current_address + sensor_config["count"] - start_address,
-                                "sensors": sensors
+                                "sensors": sensors,
+                                "_runs": _get_register_runs(sensors, start_address, float_low_byte_first)
                             })
                         sensors = dict()
                         start_address = None
@@ -160,6 +307,33 @@ class ModbusReader:
 
         return grouped_sensors
 
+    def _read(self, read_function, **kwargs):
+        """
+        Calls a read function of the modbus client. The client already reconnects on socket errors by itself and only
+        raises :class:`~pymodbus3.exceptions.ConnectionException` if it cannot connect to the modbus server. In this
+        case one more connect attempt is made before the read function is called again.
+
+        :param read_function: bound read method of the modbus client
+        :type read_function: callable
+        :param kwargs: keyword arguments of the read function
+
+        :return: response of the modbus server
+
+        :raise IOError: If connecting to the modbus server fails again
+        """
+        try:
+            return read_function(**kwargs)
+        except ConnectionException:
+            logger.info("Connecting to modbus server " + str(self.host) + ":" + str(self.port) +
+                        " failed. Trying once more.")
+
+        if not self.client.connect():
+            raise IOError("connecting to modbus server " + str(self.host) + ":" + str(self.port) + " failed")
+        try:
+            return read_function(**kwargs)
+        except ConnectionException as ex:
+            raise IOError(str(ex)) from ex
+
     def read_discretes(self, discrete_type):
         """
         read either discrete inputs or outputs
@@ -174,31 +348,25 @@ class ModbusReader:
         :raise IOError: is raised if reading discretes over TCP connection fails
         """
 
-        if discrete_type != "input" and discrete_type != "output":
+        try:
+            discretes, read_discretes = self._discretes[discrete_type]
+        except (KeyError, TypeError):
             raise AttributeError("discrete type has to be either 'input' or 'output'")
 
         sensor_readings = dict()
+        unit = self.unit
 
-        discretes = self.grouped_modbus_device_definition["discrete_" + discrete_type + "s"]
-        if len(discretes) == 0:
-            return sensor_readings
-
-        for i in range(0, len(discretes)):
-            results = None
-            if discrete_type == "input":
-                results = self.client.read_discrete_inputs(unit=self.unit, address=discretes[i]["start_address"],
-                                                           count=discretes[i]["count"])
-            if discrete_type == "output":
-                results = self.client.read_coils(unit=self.unit, address=discretes[i]["start_address"],
-                                                 count=discretes[i]["count"])
+        for group in discretes:
+            start_address = group["start_address"]
+            results = self._read(read_discretes, unit=unit, address=start_address, count=group["count"])
             try:
-                for sensor_id in discretes[i]["sensors"]:
-                    position = discretes[i]["sensors"][sensor_id]["address"] - discretes[i]["start_address"]
-                    sensor_readings.update({sensor_id: results.bits[position]})
-
+                bits = results.bits
             except AttributeError:
                 raise IOError("reading discrete " + discrete_type + "s failed")
 
+            for sensor_id, sensor_config in group["sensors"].items():
+                sensor_readings[sensor_id] = bits[sensor_config["address"] - start_address]
+
         return sensor_readings
 
     def read_registers(self, register_type):
@@ -214,57 +382,42 @@ class ModbusReader:
         :raise IOError: If reading registers over TCP connection fails
         """
 
-        if register_type != "input" and register_type != "output":
+        try:
+            registers, read_registers = self._registers[register_type]
+        except (KeyError, TypeError):
             raise AttributeError("register type has to be either 'input' or 'output'")
 
         sensor_readings = dict()
+        unit = self.unit
+        register_buffer = self._register_buffer
 
-        registers = self.grouped_modbus_device_definition[register_type + "_registers"]
-        if len(registers) == 0:
-            return sensor_readings
-
-        for i in range(0, len(registers)):
-            results = None
-            if register_type == "input":
-                results = self.client.read_input_registers(unit=self.unit, address=registers[i]["start_address"],
-                                                           count=registers[i]["count"])
-            if register_type == "output":
-                results = self.client.read_holding_registers(unit=self.unit, address=registers[i]["start_address"],
-                                                             count=registers[i]["count"])
-            for sensor_id in registers[i]["sensors"]:
-                try:
-                    register = registers[i]["sensors"][sensor_id]
-
-                    position_start = register["address"] - registers[i]["start_address"]
-                    position_end = position_start + register["count"]
-
-                    if register["type"] == "float" and self.float_low_byte_first:
-                        byte_list = structutils.int16list_to_bytes(results.registers[position_start:position_end][::-1])
-                    else:
-                        byte_list = structutils.int16list_to_bytes(results.registers[position_start:position_end])
-                    sensor_raw_value = structutils.bytes_to_datatype(byte_list, register["type"])
+        for group in registers:
+            results = self._read(read_registers, unit=unit, address=group["start_address"], count=group["count"])
+            try:
+                int16_list = results.registers
+            except AttributeError:
+                raise IOError("reading " + register_type + " registers failed")
 
+            for run in group["_runs"]:
+                run["int16list_struct"].pack_into(register_buffer, 0, *int16_list[run["slice"]])
+                sensor_raw_values = run["struct"].unpack_from(register_buffer)
+
+                for (sensor_id, register), sensor_raw_value in zip(run["sensors"], sensor_raw_values):
                     sensor_value = sensor_raw_value * register["factor"]
 
-                    if "error_correction" in register:
+                    # round before the error correction, so that the equation result keeps its own precision
+                    if "_round_digits" in register:
+                        sensor_value = round(sensor_value, register["_round_digits"])
+
+                    if "_equation" in register:
                         try:
-                            _safe_math_functions['x'] = sensor_value
-                            sensor_value = float(eval(register["error_correction"]["equation"],
-                                                      {"__builtins__": None},
-                                                      _safe_math_functions))
+                            sensor_value = float(eval(register["_equation"], dict(_error_correction_globals),
+                                                      {"x": sensor_value}))
                         except Exception as ex:
                             logger.warning("Error correction failed for sensor id " + sensor_id +
                                            ". Using original value instead. Error details: " + str(ex))
 
-                    if register["type"] in ["int16", "int32", "uint32"]:
-                        sensor_value = round(sensor_value, int(1 / register["factor"]))
-
-                    sensor_readings.update({
-                        sensor_id: sensor_value
-                    })
-
-                except AttributeError:
-                    raise IOError("reading " + register_type + " registers failed")
+                    sensor_readings[sensor_id] = sensor_value
 
         return sensor_readings
 
@@ -331,3 +484,15 @@ class ModbusReader:
             raise io_error
 
         return sensor_readings
+
+    def close(self):
+        """
+        close the connection to the modbus server
+        """
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,5 +1,7 @@
 """structutils.py: extends the function of the struct package"""
+import array
 import struct
+import sys
 
 __author__ = "Stephan Müller"
 __copyright__ = "2017, Stephan Müller"
@@ -8,13 +10,18 @@ __license__ = "MIT"
 
 _data_types = {
     "int16": "h",
-    "int32": "H",
+    "int32": "i",
     "uint32": "I",
     "float": "f",
     "byte": "x",
     "boolean": "?"
 }
 
+_data_type_structs = {data_type: struct.Struct(">" + data_type_format)
+                      for data_type, data_type_format in _data_types.items()}
+
+_swap_int16_bytes = sys.byteorder == "little"
+
 
 def get_format(data_type):
     """
@@ -31,6 +38,21 @@ def get_format(data_type):
         raise ValueError("format for given data type does not exist")
 
 
+def get_struct(data_type):
+    """
+    Get precompiled big endian struct object from human readable data type
+
+    :param data_type: human readable data type. One of: int16, int32, uint32, float, byte, boolean
+    :type data_type: str
+    :return: struct object
+    :type: struct.Struct
+    """
+    try:
+        return _data_type_structs[data_type]
+    except KeyError:
+        raise ValueError("format for given data type does not exist")
+
+
 def calcsize(data_type):
     """
     Return size in bytes of the struct described by the given data type
@@ -40,7 +62,7 @@ def calcsize(data_type):
     :return: size in bytes of the struct described by the given data type
     :type: int
     """
-    return struct.calcsize(get_format(data_type))
+    return get_struct(data_type).size
 
 
 def int16list_to_bytes(int16_list):
@@ -49,13 +71,13 @@ def int16list_to_bytes(int16_list):
 
     :param int16_list: list containing unsigned 16 bit integers
     :type int16_list: list of int
-    :return: packed integer values
+    :return: packed integer values in big endian byte order
     :type: bytes
     """
-    byte_list = b''
-    for int16_value in int16_list:
-        byte_list += struct.pack(">H", int16_value)
-    return byte_list
+    int16_array = array.array("H", int16_list)
+    if _swap_int16_bytes:
+        int16_array.byteswap()
+    return int16_array.tobytes()
 
 
 def bytes_to_datatype(byte_list, data_type):
@@ -71,7 +93,28 @@ def bytes_to_datatype(byte_list, data_type):
 
     :raise ValueError: If size of data type is not equal to the size of the bytes object.
     """
-    if calcsize(data_type) != len(byte_list):
+    data_type_struct = get_struct(data_type)
+    if data_type_struct.size != len(byte_list):
         raise ValueError("Given data type (" + data_type + ") requires different length of bytes." +
-                         " Given: " + str(len(byte_list)) + ", required: " + str(calcsize(data_type)))
-    return struct.unpack(">" + get_format(data_type), byte_list)[0]
+                         " Given: " + str(len(byte_list)) + ", required: " + str(data_type_struct.size))
+    return data_type_struct.unpack(byte_list)[0]
+
+
+def registers_to_datatype(int16_list, data_type):
+    """
+    Unpacks a list of modbus registers to the given data type
+
+    :param int16_list: list containing unsigned 16 bit integers
+    :type int16_list: list of int
+    :param data_type: human readable data type. One of: int16, int32, uint32, float, byte, boolean
+    :type data_type: str
+    :return: unpacked value
+    :type: int, float, byte, boolean
+
+    :raise ValueError: If size of data type is not equal to the size of the registers.
+    """
+    data_type_struct = get_struct(data_type)
+    if data_type_struct.size != 2 * len(int16_list):
+        raise ValueError("Given data type (" + data_type + ") requires different number of registers." +
+                         " Given: " + str(len(int16_list)) + ", required: " + str(data_type_struct.size // 2))
+    return data_type_struct.unpack(int16list_to_bytes(int16_list))[0]
@@ -30,6 +30,7 @@ setup(
         "License :: OSI Approved :: MIT License"
     ],
     install_requires=[
+        "fastjsonschema",
         "jsonschema",
         "pymodbus3"
     ],
@@ -1,8 +1,14 @@
 import unittest2
 import json
 import os
+import shutil
+import struct
+import tempfile
+from unittest import mock
+from jsonschema.exceptions import ValidationError
+from pymodbus3.exceptions import ConnectionException
 
-from modbusreader import ModbusReader
+from modbusreader import ModbusReader, _error_correction_globals, _get_register_runs
 
 __author__ = "Stephan Müller"
 __copyright__ = "2017, Stephan Müller"
@@ -10,6 +16,18 @@ __license__ = "MIT"
 
 __dirname__ = os.path.dirname(os.path.abspath(__file__))
 
+
+def float_to_registers(value, low_byte_first=False):
+    registers = list(struct.unpack(">2H", struct.pack(">f", value)))
+    return registers[::-1] if low_byte_first else registers
+
+
+def register(address, data_type, factor=1, **kwargs):
+    sensor_config = {"address": address, "description": "", "type": data_type, "unit": "", "factor": factor}
+    sensor_config.update(kwargs)
+    return sensor_config
+
+
 class ModbusReaderTests(unittest2.TestCase):
 
     CONFIG = "config.json"
@@ -23,3 +41,294 @@ class ModbusReaderTests(unittest2.TestCase):
         ModbusReader.group_modbus_device_definition(
             json.loads(open(__dirname__ + "/" + self.CONFIG, 'rb').read().decode("UTF-8"))
         )
+
+    def test_invalid_modbus_device_definition(self):
+        with self.assertRaises(ValidationError):
+            ModbusReader("localhost", 502, 0, {"discrete_inputs": {}})
+
+    def test_group_modbus_device_definition_with_gaps(self):
+        modbus_device_definition = {
+            "discrete_inputs": {
+                "a": {"address": 0, "description": "a"},
+                "b": {"address": 1, "description": "b"},
+                "c": {"address": 3, "description": "c"}
+            },
+            "discrete_outputs": {},
+            "input_registers": {
+                "d": {"address": 0, "description": "d", "type": "int16", "unit": "", "factor": 1},
+                "e": {"address": 1, "description": "e", "type": "float", "unit": "", "factor": 1},
+                "f": {"address": 4, "description": "f", "type": "int16", "unit": "", "factor": 1}
+            },
+            "output_registers": {}
+        }
+        grouped = ModbusReader.group_modbus_device_definition(modbus_device_definition)
+
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["discrete_inputs"]],
+                         [(0, 2, ["a", "b"]), (3, 1, ["c"])])
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["input_registers"]],
+                         [(0, 3, ["d", "e"]), (4, 1, ["f"])])
+        self.assertEqual(grouped["discrete_outputs"], [])
+
+        grouped = ModbusReader.group_modbus_device_definition(modbus_device_definition, max_gap=1)
+
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["discrete_inputs"]],
+                         [(0, 4, ["a", "b", "c"])])
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["input_registers"]],
+                         [(0, 5, ["d", "e", "f"])])
+
+    def test_group_modbus_device_definition_round_digits(self):
+        modbus_device_definition = {
+            "discrete_inputs": {},
+            "discrete_outputs": {},
+            "input_registers": {
+                "a": {"address": 0, "description": "a", "type": "int16", "unit": "", "factor": 0.25},
+                "b": {"address": 1, "description": "b", "type": "int16", "unit": "", "factor": 2},
+                "c": {"address": 2, "description": "c", "type": "float", "unit": "", "factor": 0.1}
+            },
+            "output_registers": {}
+        }
+        sensors = ModbusReader.group_modbus_device_definition(modbus_device_definition)["input_registers"][0]["sensors"]
+
+        self.assertEqual(sensors["a"]["_round_digits"], 2)
+        self.assertEqual(sensors["b"]["_round_digits"], 0)
+        self.assertNotIn("_round_digits", sensors["c"])
+
+    def test_error_correction_globals(self):
+        self.assertNotIn("math", _error_correction_globals)
+        self.assertEqual(eval("sqrt(x) + abs(-1)", dict(_error_correction_globals), {"x": 4}), 3)
+
+        error_correction_globals = dict(_error_correction_globals)
+        readings, _ = self.read_input_registers({
+            "a": register(0, "int16", error_correction={"equation": "[(sqrt := 0) for _ in [0]][0] + x"}),
+            "b": register(1, "int16", error_correction={"equation": "sqrt(x)"})
+        }, [4, 9])
+
+        self.assertEqual(readings, {"a": 4, "b": 3})
+        self.assertEqual(_error_correction_globals, error_correction_globals)
+
+    def test_group_modbus_device_definition_rejects_types_smaller_than_a_register(self):
+        for data_type in ["byte", "boolean"]:
+            modbus_device_definition = {
+                "discrete_inputs": {},
+                "discrete_outputs": {},
+                "input_registers": {
+                    "a": {"address": 0, "description": "a", "type": "float", "unit": "", "factor": 1},
+                    "b": {"address": 2, "description": "b", "type": data_type, "unit": "", "factor": 1}
+                },
+                "output_registers": {}
+            }
+            with self.assertRaises(ValueError):
+                ModbusReader.group_modbus_device_definition(modbus_device_definition)
+
+    def test_get_register_runs_rejects_size_mismatch(self):
+        sensors = {"a": {"address": 0, "type": "byte", "count": 0}}
+        with self.assertRaises(ValueError):
+            _get_register_runs(sensors, 0, False)
+
+    def read_input_registers(self, input_registers, registers, float_low_byte_first=False, max_gap=0):
+        modbus_device_definition = {
+            "discrete_inputs": {},
+            "discrete_outputs": {},
+            "input_registers": input_registers,
+            "output_registers": {}
+        }
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client = client_class.return_value
+            client.connect.return_value = True
+            client.read_input_registers.side_effect = \
+                lambda unit, address, count: mock.Mock(registers=registers[address:address + count])
+            reader = ModbusReader("localhost", 502, 0, modbus_device_definition, float_low_byte_first, max_gap)
+            return reader.read_input_registers(), client.read_input_registers.call_count
+
+    def test_read_registers_mixed_types(self):
+        registers = [123, 0xffff] + float_to_registers(1.5) + float_to_registers(-2.25) + [1, 2]
+        readings, calls = self.read_input_registers({
+            "a": register(0, "int16", 0.1),
+            "b": register(1, "int16"),
+            "c": register(2, "float"),
+            "d": register(4, "float", 0.5),
+            "e": register(6, "uint32")
+        }, registers)
+
+        self.assertEqual(readings, {"a": 12.3, "b": -1, "c": 1.5, "d": -1.125, "e": 65538})
+        self.assertEqual(calls, 1)
+
+    def test_read_registers_float_low_byte_first_at_group_start(self):
+        registers = float_to_registers(1.5, True) + float_to_registers(-2.25, True) + [7]
+        readings, _ = self.read_input_registers({
+            "a": register(0, "float"),
+            "b": register(2, "float"),
+            "c": register(4, "int16")
+        }, registers, float_low_byte_first=True)
+
+        self.assertEqual(readings, {"a": 1.5, "b": -2.25, "c": 7})
+
+    def test_read_registers_float_low_byte_first_inside_group(self):
+        registers = [7] + float_to_registers(1.5, True) + float_to_registers(-2.25, True)
+        readings, _ = self.read_input_registers({
+            "a": register(0, "int16"),
+            "b": register(1, "float"),
+            "c": register(3, "float")
+        }, registers, float_low_byte_first=True)
+
+        self.assertEqual(readings, {"a": 7, "b": 1.5, "c": -2.25})
+
+    def test_read_registers_negative_int32(self):
+        readings, _ = self.read_input_registers({"a": register(0, "int32")}, [0xffff, 0xfffe])
+
+        self.assertEqual(readings, {"a": -2})
+
+    def test_read_registers_error_correction(self):
+        readings, _ = self.read_input_registers({
+            "a": register(0, "int16", error_correction={"equation": "x * 2 + sqrt(4)"}),
+            "b": register(1, "int16", error_correction={"equation": "x +* 2"})
+        }, [5, 5])
+
+        self.assertEqual(readings, {"a": 12, "b": 5})
+
+    def test_read_registers_error_correction_keeps_precision(self):
+        readings, _ = self.read_input_registers({
+            "a": register(0, "int16", error_correction={"equation": "x * 0.0625 - 40"}),
+            "b": register(1, "int16", error_correction={"equation": "x * 0.5"}),
+            "c": register(2, "int16", 0.1, error_correction={"equation": "x / 3"})
+        }, [1000, 5, 10])
+
+        self.assertEqual(readings, {"a": 22.5, "b": 2.5, "c": 1 / 3})
+
+    def test_read_registers_max_gap(self):
+        registers = [1, 0, 0] + float_to_registers(1.5)
+        readings, calls = self.read_input_registers({
+            "a": register(0, "int16"),
+            "b": register(3, "float")
+        }, registers, max_gap=2)
+
+        self.assertEqual(readings, {"a": 1, "b": 1.5})
+        self.assertEqual(calls, 1)
+
+    def test_connect_failure(self):
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client_class.return_value.connect.return_value = False
+            with self.assertRaises(IOError):
+                ModbusReader("localhost", 502, 0, __dirname__ + "/" + self.CONFIG)
+
+    def test_read_retries_connect_once(self):
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client = client_class.return_value
+            client.connect.return_value = True
+            client.read_discrete_inputs.side_effect = [ConnectionException("failed"), mock.Mock(bits=[True])]
+            reader = ModbusReader("localhost", 502, 0, __dirname__ + "/" + self.CONFIG)
+
+            self.assertEqual(reader.read_discrete_inputs(), {"test": True})
+            self.assertEqual(client.connect.call_count, 2)
+
+            client.read_discrete_inputs.side_effect = ConnectionException("failed")
+            with self.assertRaises(IOError):
+                reader.read_discrete_inputs()
+
+            client.connect.return_value = False
+            with self.assertRaises(IOError):
+                reader.read_discrete_inputs()
+
+    def test_close_and_context_manager(self):
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client = client_class.return_value
+            client.connect.return_value = True
+
+            reader = ModbusReader("localhost", 502, 0, __dirname__ + "/" + self.CONFIG)
+            reader.close()
+            self.assertEqual(client.close.call_count, 1)
+
+            with ModbusReader("localhost", 502, 0, __dirname__ + "/" + self.CONFIG) as reader:
+                self.assertIsInstance(reader, ModbusReader)
+                self.assertEqual(client.close.call_count, 1)
+            self.assertEqual(client.close.call_count, 2)
+
+    def write_config(self, directory, address, modification_time):
+        file_name = os.path.join(directory, self.CONFIG)
+        with open(__dirname__ + "/" + self.CONFIG, encoding="utf-8") as config_file:
+            modbus_device_definition = json.load(config_file)
+        modbus_device_definition["discrete_inputs"]["test"]["address"] = address
+        with open(file_name, "w", encoding="utf-8") as config_file:
+            json.dump(modbus_device_definition, config_file)
+        os.utime(file_name, (modification_time, modification_time))
+        return file_name
+
+    def test_modbus_device_definition_file_cache(self):
+        directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        working_directory = os.getcwd()
+        self.addCleanup(lambda: [shutil.rmtree(directory) for directory in directories])
+        self.addCleanup(os.chdir, working_directory)
+
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client_class.return_value.connect.return_value = True
+
+            def start_address(file_name):
+                reader = ModbusReader("localhost", 502, 0, file_name)
+                return reader.grouped_modbus_device_definition["discrete_inputs"][0]["start_address"]
+
+            file_name = self.write_config(directories[0], 1, 1000000)
+            self.assertEqual(start_address(file_name), 1)
+
+            self.write_config(directories[0], 2, 1000010)
+            self.assertEqual(start_address(file_name), 2)
+
+            # same relative file name and modification time in another directory
+            self.write_config(directories[1], 3, 1000010)
+            os.chdir(directories[0])
+            self.assertEqual(start_address(self.CONFIG), 2)
+            os.chdir(directories[1])
+            self.assertEqual(start_address(self.CONFIG), 3)
+
+            first_reader = ModbusReader("localhost", 502, 0, self.CONFIG)
+            first_reader.grouped_modbus_device_definition["discrete_inputs"][0]["sensors"]["test"]["address"] = 9
+            second_reader = ModbusReader("localhost", 502, 0, self.CONFIG)
+            self.assertEqual(second_reader.grouped_modbus_device_definition["discrete_inputs"][0]["sensors"]["test"]
+                             ["address"], 3)
+
+    def test_read_invalid_type(self):
+        with mock.patch("modbusreader.ModbusTcpClient") as client_class:
+            client_class.return_value.connect.return_value = True
+            reader = ModbusReader("localhost", 502, 0, __dirname__ + "/" + self.CONFIG)
+
+            for invalid_type in ["inputs", ["input"]]:
+                with self.assertRaises(AttributeError):
+                    reader.read_discretes(invalid_type)
+                with self.assertRaises(AttributeError):
+                    reader.read_registers(invalid_type)
+
+    def test_group_modbus_device_definition_request_limits(self):
+        modbus_device_definition = {
+            "discrete_inputs": {
+                "a": {"address": 0, "description": "a"},
+                "b": {"address": 1999, "description": "b"},
+                "c": {"address": 2000, "description": "c"}
+            },
+            "discrete_outputs": {},
+            "input_registers": {
+                "d": {"address": 0, "description": "d", "type": "int16", "unit": "", "factor": 1},
+                "e": {"address": 123, "description": "e", "type": "float", "unit": "", "factor": 1},
+                "f": {"address": 125, "description": "f", "type": "int16", "unit": "", "factor": 1},
+                "g": {"address": 200, "description": "g", "type": "int16", "unit": "", "factor": 1}
+            },
+            "output_registers": {}
+        }
+        grouped = ModbusReader.group_modbus_device_definition(modbus_device_definition, max_gap=2000)
+
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["discrete_inputs"]],
+                         [(0, 2000, ["a", "b"]), (2000, 1, ["c"])])
+        self.assertEqual([(group["start_address"], group["count"], sorted(group["sensors"]))
+                          for group in grouped["input_registers"]],
+                         [(0, 125, ["d", "e"]), (125, 76, ["f", "g"])])
+
+    def test_group_modbus_device_definition_invalid_max_gap(self):
+        modbus_device_definition = json.loads(open(__dirname__ + "/" + self.CONFIG, 'rb').read().decode("UTF-8"))
+        for max_gap in [-1, 1.5, "1", True]:
+            with self.assertRaises(ValueError):
+                ModbusReader.group_modbus_device_definition(modbus_device_definition, max_gap=max_gap)
+            with self.assertRaises(ValueError):
+                ModbusReader("localhost", 502, 0, modbus_device_definition, max_gap=max_gap)
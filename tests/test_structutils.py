@@ -13,16 +13,26 @@ class StructUtilsTests(unittest2.TestCase):
         with self.assertRaises(ValueError):
             structutils.get_format("nonexisting_data_type")
 
+    def test_get_struct(self):
+        self.assertEqual(structutils.get_struct("float").size, 4)
+
+        with self.assertRaises(ValueError):
+            structutils.get_struct("nonexisting_data_type")
+
     def test_calcsize(self):
         self.assertEqual(structutils.calcsize("int16"), 2)
-        self.assertEqual(structutils.calcsize("int32"), 2)
+        self.assertEqual(structutils.calcsize("int32"), 4)
         self.assertEqual(structutils.calcsize("uint32"), 4)
         self.assertEqual(structutils.calcsize("float"), 4)
         self.assertEqual(structutils.calcsize("byte"), 1)
 
+        with self.assertRaises(ValueError):
+            structutils.calcsize("nonexisting_data_type")
+
     def test_int16list_to_bytes(self):
         int16_list = [0, 1]
         self.assertEqual(structutils.int16list_to_bytes(int16_list),  b'\x00\x00\x00\x01')
+        self.assertEqual(structutils.int16list_to_bytes([]), b'')
 
     def test_bytes_to_datatype(self):
         byte_list = b'\x00\x00'
@@ -33,6 +43,15 @@ class StructUtilsTests(unittest2.TestCase):
         data_type = "int16"
         self.assertEqual(structutils.bytes_to_datatype(byte_list, data_type), 1)
 
+    def test_registers_to_datatype(self):
+        self.assertEqual(structutils.registers_to_datatype([1], "int16"), 1)
+        self.assertEqual(structutils.registers_to_datatype([0xffff], "int16"), -1)
+        self.assertEqual(structutils.registers_to_datatype([0xffff, 0xfffe], "int32"), -2)
+        self.assertEqual(structutils.registers_to_datatype([0x3f80, 0], "float"), 1.0)
+
+        with self.assertRaisesRegex(ValueError, "required: 2$"):
+            structutils.registers_to_datatype([0], "float")
+
 
 if __name__ == '__main__':
     unittest2.main()